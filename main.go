@@ -2,11 +2,22 @@ package main
 
 import (
 	"bytes"
+	"context"
+	"encoding/base64"
 	"encoding/json"
+	"errors"
+	"flag"
+	"fmt"
 	"log"
+	"math"
+	"math/rand"
+	"net"
 	"net/http"
 	"os"
+	"os/signal"
 	"strconv"
+	"strings"
+	"syscall"
 	"time"
 
 	"github.com/joho/godotenv"
@@ -24,6 +35,22 @@ type Region struct {
 	Name string `json:"name"`
 }
 
+// apiError is returned for non-2xx API responses so the retry logic can
+// inspect the status code and any Retry-After hint from the server.
+type apiError struct {
+	StatusCode int
+	RetryAfter int // seconds, 0 if the server sent no hint
+}
+
+func (e *apiError) Error() string {
+	return fmt.Sprintf("API returned status %d", e.StatusCode)
+}
+
+func newAPIError(resp *http.Response) *apiError {
+	retryAfter, _ := strconv.Atoi(resp.Header.Get("Retry-After"))
+	return &apiError{StatusCode: resp.StatusCode, RetryAfter: retryAfter}
+}
+
 type LaunchPayload struct {
 	RegionName       string   `json:"region_name"`
 	InstanceTypeName string   `json:"instance_type_name"`
@@ -31,13 +58,62 @@ type LaunchPayload struct {
 	Quantity         int      `json:"quantity"`
 }
 
+// separator visually splits poll iterations in the log output.
+const separator = "========================================"
+
 var (
-	apiKey           string
-	instanceTypeName string
-	sshKeyName       string
-	checkInterval    int
-	errorWait        int
-	baseUrl          = "https://cloud.lambdalabs.com/api/v1/"
+	apiKey            string
+	authHeader        string
+	instanceTypeNames []string
+	sshKeyName        string
+	stateFile         string
+	port              string
+	checkInterval     int
+	errorWait         int
+	baseUrl           = "https://cloud.lambdalabs.com/api/v1/"
+
+	// Cap for the exponential error backoff, in seconds.
+	maxBackoffSeconds = 60.0
+
+	// Shared client so the keep-alive connection to the API survives between
+	// polls instead of paying a TCP+TLS handshake on every check.
+	httpClient = &http.Client{
+		Timeout: 30 * time.Second,
+		Transport: &http.Transport{
+			// A custom Transport still negotiates HTTP/2 on its own while
+			// no custom dialer or TLSClientConfig is set, but adding either
+			// later would silently disable that. Keep the opt-in explicit
+			// so the catalog GET, the hanging long poll and the launch POST
+			// stay multiplexed over one connection instead of queueing on
+			// HTTP/1.1 keep-alive.
+			Proxy:               http.ProxyFromEnvironment,
+			ForceAttemptHTTP2:   true,
+			MaxIdleConns:        4,
+			MaxIdleConnsPerHost: 4,
+			IdleConnTimeout:     120 * time.Second,
+			TLSHandshakeTimeout: 10 * time.Second,
+		},
+	}
+
+	// Cached instance-types catalog. Availability is embedded in the same
+	// response here, so the TTL is tied to the poll interval rather than
+	// the hours-scale staleness the rest of the metadata could tolerate;
+	// within one tick every consumer shares a single fetch.
+	cachedInstanceTypes InstanceTypes
+	cacheFetchedAt      time.Time
+	cacheTTL            time.Duration
+
+	// ETag of the last instance-types response, sent back as
+	// If-None-Match so an unchanged catalog costs a header-only 304
+	// instead of a full body download and JSON decode.
+	lastEtag string
+
+	// Shares httpClient's transport (and its keep-alive pool) but with a
+	// timeout generous enough for the server to hold a hanging GET open.
+	longpollClient = &http.Client{
+		Timeout:   130 * time.Second,
+		Transport: httpClient.Transport,
+	}
 )
 
 func init() {
@@ -46,12 +122,24 @@ func init() {
 	}
 
 	apiKey = os.Getenv("LAMBDA_API_KEY")
-	instanceTypeName = os.Getenv("INSTANCE_TYPE_NAME")
-	if instanceTypeName == "" {
-		instanceTypeName = "gpu_1x_a6000"
+	// Credentials never change at runtime, so encode the basic-auth
+	// header once instead of re-encoding it on every request.
+	authHeader = "Basic " + base64.StdEncoding.EncodeToString([]byte(apiKey+":"))
+	for _, name := range strings.Split(os.Getenv("INSTANCE_TYPE_NAME"), ",") {
+		if name = strings.TrimSpace(name); name != "" {
+			instanceTypeNames = append(instanceTypeNames, name)
+		}
+	}
+	if len(instanceTypeNames) == 0 {
+		instanceTypeNames = []string{"gpu_1x_a6000"}
 	}
 
 	sshKeyName = os.Getenv("SSH_KEY_NAME")
+	stateFile = os.Getenv("STATE_FILE")
+	port = os.Getenv("PORT")
+	if port == "" {
+		port = "5000"
+	}
 	checkInterval, _ = strconv.Atoi(os.Getenv("CHECK_INTERVAL_SECONDS"))
 	if checkInterval == 0 {
 		checkInterval = 30
@@ -61,46 +149,138 @@ func init() {
 	if errorWait == 0 {
 		errorWait = 10
 	}
+
+	cacheTTL = time.Duration(checkInterval) * time.Second
 }
 
-func getInstanceTypes() (InstanceTypes, error) {
-	log.Printf(`Checking availability for %s...`, instanceTypeName)
-	client := &http.Client{}
-	req, err := http.NewRequest("GET", baseUrl+"instance-types", nil)
+func getInstanceTypes(ctx context.Context) (InstanceTypes, error) {
+	if !cacheFetchedAt.IsZero() && time.Since(cacheFetchedAt) < cacheTTL {
+		return cachedInstanceTypes, nil
+	}
+
+	log.Printf(`Checking availability for %s...`, strings.Join(instanceTypeNames, ", "))
+	req, err := http.NewRequestWithContext(ctx, "GET", baseUrl+"instance-types", nil)
 	if err != nil {
 		return InstanceTypes{}, err
 	}
 
-	req.SetBasicAuth(apiKey, "")
-	resp, err := client.Do(req)
+	req.Header.Set("Authorization", authHeader)
+	if lastEtag != "" {
+		req.Header.Set("If-None-Match", lastEtag)
+	}
+	resp, err := httpClient.Do(req)
 	if err != nil {
 		return InstanceTypes{}, err
 	}
 	defer resp.Body.Close()
 
+	if resp.StatusCode == http.StatusNotModified {
+		cacheFetchedAt = time.Now()
+		return cachedInstanceTypes, nil
+	}
+	if resp.StatusCode >= 400 {
+		return InstanceTypes{}, newAPIError(resp)
+	}
+
+	return decodeAndCache(resp)
+}
+
+// decodeAndCache decodes an instance-types response body and records it,
+// together with its ETag, for the TTL cache and conditional requests.
+func decodeAndCache(resp *http.Response) (InstanceTypes, error) {
 	var instanceTypes InstanceTypes
-	err = json.NewDecoder(resp.Body).Decode(&instanceTypes)
-	if err != nil {
+	if err := json.NewDecoder(resp.Body).Decode(&instanceTypes); err != nil {
 		return InstanceTypes{}, err
 	}
 
+	cachedInstanceTypes = instanceTypes
+	cacheFetchedAt = time.Now()
+	lastEtag = resp.Header.Get("ETag")
+
 	return instanceTypes, nil
 }
 
-func checkInstanceAvailability(instanceTypes InstanceTypes) (string, error) {
-	if data, exists := instanceTypes.Data[instanceTypeName]; exists {
-		if len(data.RegionsWithCapacityAvailable) > 0 {
-			return data.RegionsWithCapacityAvailable[0].Name, nil
+// refreshInstanceTypes drops the cached catalog so the next
+// getInstanceTypes call hits the API.
+func refreshInstanceTypes() {
+	cacheFetchedAt = time.Time{}
+}
+
+// pollAvailabilityLongpoll asks the API to hold the request open until
+// capacity changes instead of answering immediately. Servers that ignore
+// the wait parameter just return a normal snapshot, and servers that
+// reject it make us fall back to the plain getInstanceTypes fetch, so in
+// the worst case this degrades to the existing short poll.
+func pollAvailabilityLongpoll(ctx context.Context) (InstanceTypes, error) {
+	req, err := http.NewRequestWithContext(ctx, "GET", baseUrl+"instance-types?wait=1", nil)
+	if err != nil {
+		return InstanceTypes{}, err
+	}
+
+	req.Header.Set("Authorization", authHeader)
+	if lastEtag != "" {
+		req.Header.Set("If-None-Match", lastEtag)
+	}
+	resp, err := longpollClient.Do(req)
+	if err != nil {
+		return InstanceTypes{}, err
+	}
+	defer resp.Body.Close()
+
+	if resp.StatusCode == http.StatusNotModified {
+		cacheFetchedAt = time.Now()
+		return cachedInstanceTypes, nil
+	}
+	if resp.StatusCode >= 400 {
+		return getInstanceTypes(ctx)
+	}
+
+	return decodeAndCache(resp)
+}
+
+// backoffDelay computes a truncated exponential backoff with jitter for
+// the given consecutive failure count, honoring a server-sent Retry-After
+// when it is longer than the computed wait.
+func backoffDelay(failCount int, err error) time.Duration {
+	delay := float64(errorWait) * math.Pow(2, float64(failCount))
+	if delay > maxBackoffSeconds {
+		delay = maxBackoffSeconds
+	}
+	delay += rand.Float64()
+
+	var apiErr *apiError
+	if errors.As(err, &apiErr) && float64(apiErr.RetryAfter) > delay {
+		delay = float64(apiErr.RetryAfter)
+	}
+
+	return time.Duration(delay * float64(time.Second))
+}
+
+// isTimeout reports whether err is a network timeout, i.e. the server held
+// a hanging GET for its full window without news and we should reissue.
+func isTimeout(err error) bool {
+	var netErr net.Error
+	return errors.As(err, &netErr) && netErr.Timeout()
+}
+
+// checkInstanceAvailability scans the configured instance types in
+// preference order against one catalog snapshot and returns the first
+// type with capacity together with its region.
+func checkInstanceAvailability(instanceTypes InstanceTypes) (string, string, error) {
+	for _, typeName := range instanceTypeNames {
+		if data, exists := instanceTypes.Data[typeName]; exists {
+			if len(data.RegionsWithCapacityAvailable) > 0 {
+				return typeName, data.RegionsWithCapacityAvailable[0].Name, nil
+			}
 		}
 	}
-	return "", nil
+	return "", "", nil
 }
 
-func launchInstance(regionName string) (interface{}, error) {
-	client := &http.Client{}
+func launchInstance(ctx context.Context, typeName, regionName string) (json.RawMessage, error) {
 	payload := LaunchPayload{
 		RegionName:       regionName,
-		InstanceTypeName: instanceTypeName,
+		InstanceTypeName: typeName,
 		SSHKeyNames:      []string{sshKeyName},
 		Quantity:         1,
 	}
@@ -109,20 +289,26 @@ func launchInstance(regionName string) (interface{}, error) {
 		return nil, err
 	}
 
-	req, err := http.NewRequest("POST", baseUrl+"instance-operations/launch", bytes.NewBuffer(jsonPayload))
+	req, err := http.NewRequestWithContext(ctx, "POST", baseUrl+"instance-operations/launch", bytes.NewBuffer(jsonPayload))
 	if err != nil {
 		return nil, err
 	}
 
-	req.SetBasicAuth(apiKey, "")
+	req.Header.Set("Authorization", authHeader)
 	req.Header.Set("Content-Type", "application/json")
-	resp, err := client.Do(req)
+	resp, err := httpClient.Do(req)
 	if err != nil {
 		return nil, err
 	}
 	defer resp.Body.Close()
 
-	var result interface{}
+	if resp.StatusCode >= 400 {
+		return nil, newAPIError(resp)
+	}
+
+	// The result is only logged, so keep it as validated raw JSON instead
+	// of materializing a tree of maps and strings.
+	var result json.RawMessage
 	err = json.NewDecoder(resp.Body).Decode(&result)
 	if err != nil {
 		return nil, err
@@ -131,42 +317,218 @@ func launchInstance(regionName string) (interface{}, error) {
 	return result, nil
 }
 
-func launchInstanceLoop() {
-	for {
-		log.Println("========================================")
-		instanceTypes, err := getInstanceTypes()
-		if err != nil {
-			log.Printf("Error fetching instance types: %v. Retrying in %d seconds.\n", err, errorWait)
-			time.Sleep(time.Duration(errorWait) * time.Second)
-			continue
-		}
+// sleep waits for d unless ctx is cancelled first; it reports whether the
+// full wait elapsed.
+func sleep(ctx context.Context, d time.Duration) bool {
+	timer := time.NewTimer(d)
+	defer timer.Stop()
+	select {
+	case <-timer.C:
+		return true
+	case <-ctx.Done():
+		return false
+	}
+}
 
-		regionName, err := checkInstanceAvailability(instanceTypes)
-		if err != nil {
-			log.Printf("Error checking availability: %v. Retrying in %d seconds.\n", err, errorWait)
-			time.Sleep(time.Duration(errorWait) * time.Second)
-			continue
-		}
+type attemptResult string
+
+const (
+	attemptWait     attemptResult = "wait"
+	attemptLaunched attemptResult = "launched"
+	attemptError    attemptResult = "error"
+)
+
+// botState is what survives between one-shot invocations so a scheduled
+// run picks up where the previous one left off.
+type botState struct {
+	FailCount int           `json:"fail_count"`
+	Etag      string        `json:"etag"`
+	Catalog   InstanceTypes `json:"catalog"`
+}
+
+// loadState restores the persisted state from STATE_FILE, if configured.
+// It returns a zero state when there is nothing to restore. The catalog is
+// restored together with its ETag: a 304 answer to the conditional GET is
+// only meaningful if the body it refers to is on hand, otherwise an empty
+// catalog would masquerade as "no capacity".
+func loadState() botState {
+	var state botState
+	if stateFile == "" {
+		return state
+	}
+	data, err := os.ReadFile(stateFile)
+	if err != nil {
+		return state
+	}
+	if err := json.Unmarshal(data, &state); err != nil {
+		return botState{}
+	}
+	if state.Etag != "" && state.Catalog.Data != nil {
+		lastEtag = state.Etag
+		cachedInstanceTypes = state.Catalog
+	}
+	return state
+}
 
-		if regionName != "" {
-			result, err := launchInstance(regionName)
-			if err != nil {
-				log.Printf("Error launching instance: %v. Retrying in %d seconds.", err, errorWait)
-				time.Sleep(time.Duration(errorWait) * time.Second)
+// saveState persists the failure count plus the current catalog and its
+// ETag to STATE_FILE, if configured.
+func saveState(failCount int) {
+	if stateFile == "" {
+		return
+	}
+	data, err := json.Marshal(botState{
+		FailCount: failCount,
+		Etag:      lastEtag,
+		Catalog:   cachedInstanceTypes,
+	})
+	if err != nil {
+		return
+	}
+	if err := os.WriteFile(stateFile, data, 0o600); err != nil {
+		log.Printf("Error saving state to %s: %v\n", stateFile, err)
+	}
+}
+
+// tryOnce performs a single availability check and, when capacity exists,
+// a single launch attempt. poll picks how the snapshot is obtained: the
+// daemon loop long-polls, while one-shot runs take a plain snapshot so
+// they exit fast.
+func tryOnce(ctx context.Context, poll func(context.Context) (InstanceTypes, error)) (attemptResult, error) {
+	instanceTypes, err := poll(ctx)
+	if err != nil {
+		return attemptError, fmt.Errorf("fetching instance types: %w", err)
+	}
+
+	typeName, regionName, err := checkInstanceAvailability(instanceTypes)
+	if err != nil {
+		return attemptError, fmt.Errorf("checking availability: %w", err)
+	}
+	if regionName == "" {
+		return attemptWait, nil
+	}
+
+	result, err := launchInstance(ctx, typeName, regionName)
+	if err != nil {
+		// A failed launch usually means the capacity snapshot went stale
+		// between the poll and the POST; drop it so the retry refetches.
+		refreshInstanceTypes()
+		return attemptError, fmt.Errorf("launching instance: %w", err)
+	}
+
+	log.Printf("Instance launch result: %s\n", result)
+	return attemptLaunched, nil
+}
+
+func launchInstanceLoop(ctx context.Context) {
+	failCount := 0
+	for {
+		log.Println(separator)
+		result, err := tryOnce(ctx, pollAvailabilityLongpoll)
+		switch result {
+		case attemptLaunched:
+			return
+		case attemptWait:
+			failCount = 0
+			log.Printf(`No available regions for %s. Checking again in %d sec.`, strings.Join(instanceTypeNames, ", "), checkInterval)
+			if !sleep(ctx, time.Duration(checkInterval)*time.Second) {
+				return
+			}
+		case attemptError:
+			if ctx.Err() != nil {
+				return
+			}
+			if isTimeout(err) {
 				continue
 			}
-
-			log.Printf("Instance launch result: %v\n", result)
-			break
-		} else {
-			log.Printf(`No available regions for %s. Checking again in %d sec.`, instanceTypeName, checkInterval)
+			delay := backoffDelay(failCount, err)
+			failCount++
+			log.Printf("Error %v. Retrying in %.1f seconds.\n", err, delay.Seconds())
+			if !sleep(ctx, delay) {
+				return
+			}
 		}
+	}
+}
+
+// runOnce performs one scheduled attempt, carrying the ETag and failure
+// count across invocations through STATE_FILE. It returns the process
+// exit code.
+func runOnce(ctx context.Context) int {
+	state := loadState()
+
+	result, err := tryOnce(ctx, getInstanceTypes)
+	switch result {
+	case attemptError:
+		// The scheduler owns the cadence, so the persisted failure count
+		// cannot drive a sleep here; surface the backoff it would have
+		// produced as a hint for the next scheduled run.
+		delay := backoffDelay(state.FailCount, err)
+		state.FailCount++
+		log.Printf("Error %v. Suggest retrying in %.1f seconds.\n", err, delay.Seconds())
+	case attemptWait:
+		state.FailCount = 0
+		log.Printf(`No available regions for %s.`, strings.Join(instanceTypeNames, ", "))
+	default:
+		state.FailCount = 0
+	}
 
-		time.Sleep(time.Duration(checkInterval) * time.Second)
+	saveState(state.FailCount)
+	if result == attemptError {
+		return 1
 	}
+	return 0
+}
+
+// startHealthServer serves /health on PORT for platform liveness probes
+// and drains gracefully when ctx is cancelled. Go's http.Server handles
+// keep-alive and sets TCP_NODELAY on accepted connections by default, so
+// tiny probe responses go out without delay.
+func startHealthServer(ctx context.Context) {
+	mux := http.NewServeMux()
+	mux.HandleFunc("/health", func(w http.ResponseWriter, r *http.Request) {
+		w.WriteHeader(http.StatusOK)
+		w.Write([]byte("OK"))
+	})
+
+	server := &http.Server{
+		Addr:              ":" + port,
+		Handler:           mux,
+		ReadHeaderTimeout: 5 * time.Second,
+		IdleTimeout:       120 * time.Second,
+	}
+
+	go func() {
+		<-ctx.Done()
+		shutdownCtx, cancel := context.WithTimeout(context.Background(), 5*time.Second)
+		defer cancel()
+		server.Shutdown(shutdownCtx)
+	}()
+
+	go func() {
+		log.Printf("Health server listening on :%s\n", port)
+		if err := server.ListenAndServe(); err != nil && !errors.Is(err, http.ErrServerClosed) {
+			log.Printf("Health server error: %v\n", err)
+		}
+	}()
 }
 
 func main() {
+	once := flag.Bool("once", false, "check and attempt a launch a single time, then exit (for cron or similar schedulers)")
+	flag.Parse()
+
+	ctx, stop := signal.NotifyContext(context.Background(), os.Interrupt, syscall.SIGTERM)
+	defer stop()
+
 	log.Println("Starting lambdalabs-bot...")
-	launchInstanceLoop()
+
+	if *once {
+		os.Exit(runOnce(ctx))
+	}
+
+	startHealthServer(ctx)
+	launchInstanceLoop(ctx)
+
+	if ctx.Err() != nil {
+		log.Println("Shutting down...")
+	}
 }